@@ -64,11 +64,12 @@ def pull_modified_threads(conn):
       message_id, attachments = cfbot_commitfest_rpc.get_latest_patches_from_thread_url(url)
     cursor2.execute("""UPDATE submission
                           SET last_email_time_checked = %s,
-                              last_message_id = %s
+                              last_message_id = %s,
+                              thread_url = %s
                               --last_branch_message_id = NULL
                         WHERE commitfest_id = %s
                           AND submission_id = %s""",
-                    (last_email_time, message_id, commitfest_id, submission_id))
+                    (last_email_time, message_id, url, commitfest_id, submission_id))
     conn.commit()
 
 def push_build_results(conn):
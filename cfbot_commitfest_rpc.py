@@ -3,10 +3,11 @@
 # Routines that interface with the Commitfest app.
 # For now these use webscraping, but they could become real API calls.
 
+import cfbot_config
 import cfbot_util
 import datetime
 import errno
-from HTMLParser import HTMLParser
+from html import unescape
 import os
 import re
 import requests
@@ -18,6 +19,23 @@ import time
 import unicodedata
 from urllib.parse import urlparse
 
+# Patterns used to scrape the Commitfest app and the mailing list archives.
+ATTACHMENT_RE = re.compile('<a href="(/message-id/attachment/[^"]*\\.(diff|diff\\.gz|patch|patch\\.gz|tar\\.gz|tgz|tar\\.bz2))">')
+MESSAGE_ID_RE = re.compile('<td><a href="/message-id/[^"]+">([^"]+)</a></td>')
+LATEST_AT_RE = re.compile("""Latest at <a href="https://www.postgresql.org/message-id/([^"]+)">(2[^<]+)""")
+LATEST_ATTACHMENT_RE = re.compile("""Latest attachment .* <button type="button" """)
+VERSION_RE = re.compile("<td><span [^>]*>([^<]*)</span></td>")
+TD_RE = re.compile("<td>([^<]*)</td>")
+# one pass over each line of the Commitfest page, telling us which of the
+# interesting cells (if any) it holds via lastgroup
+SUBMISSION_LINE_RE = re.compile('(?P<submission><a href="([0-9]+)/">([^<]+)</a>)'
+                                '|(?P<status><td><span class="label label-[^"]*">([^<]+)</span></td>)'
+                                '|(?P<email><td style="white-space: nowrap;">(.*)<br/>(.*)</td>)')
+COMMITFEST_RE = re.compile('<a href="/([0-9]+)/">[0-9]+-[0-9]+</a> \\((Open|In Progress) ')
+
+# attachments that we unpack rather than apply directly
+TARBALL_SUFFIXES = (".tgz", ".tar.gz", ".tar.bz2")
+
 class Submission:
   """A submission in a Commitfest."""
 
@@ -39,14 +57,17 @@ def get_latest_patches_from_thread_url(thread_url):
   selected_message_id = None
   message_attachments = []
   message_id = None
-  for line in cfbot_util.slow_fetch(thread_url).splitlines():
-    groups = re.search('<a href="(/message-id/attachment/[^"]*\\.(diff|diff\\.gz|patch|patch\\.gz|tar\\.gz|tgz|tar\\.bz2))">', line)
+  for line in cfbot_util.slow_fetch_lines(thread_url):
+    # both patterns below need this, so skip the bulk of the page cheaply
+    if '/message-id/' not in line:
+      continue
+    groups = ATTACHMENT_RE.search(line)
     if groups and not groups.group(1).endswith("jabiru_2022-03-28_20-25-16.tar.gz"):
       message_attachments.append("https://www.postgresql.org" + groups.group(1))
       selected_message_attachments = message_attachments
       selected_message_id = message_id
     #groups = re.search('<a name="([^"]+)"></a>', line)
-    groups = re.search('<td><a href="/message-id/[^"]+">([^"]+)</a></td>', line)
+    groups = MESSAGE_ID_RE.search(line)
     if groups:
       message_id = groups.group(1)
       message_attachments = []
@@ -54,7 +75,7 @@ def get_latest_patches_from_thread_url(thread_url):
   # otherwise give up on this thread (we don't know how to combine patches and
   # tarballs)
   if selected_message_attachments != None:
-    if any(x.endswith(".tgz") or x.endswith(".tar.gz") or x.endswith(".tar.bz2") for x in selected_message_attachments):
+    if any(x.endswith(TARBALL_SUFFIXES) for x in selected_message_attachments):
       if len(selected_message_attachments) > 1:
         selected_message_id = None
         selected_message_attachments = None
@@ -71,12 +92,15 @@ def get_thread_url_for_submission(commitfest_id, submission_id):
   url = "https://commitfest.postgresql.org/%s/%s/" % (commitfest_id, submission_id)
   candidates = []
   candidate = None
-  for line in cfbot_util.slow_fetch(url).splitlines():
-    groups = re.search("""Latest at <a href="https://www.postgresql.org/message-id/([^"]+)">(2[^<]+)""", line)
+  for line in cfbot_util.slow_fetch_lines(url):
+    # "Latest at" is a prefix of "Latest attachment" too
+    if 'Latest at' not in line:
+      continue
+    groups = LATEST_AT_RE.search(line)
     if groups:
       candidate = (groups.group(2), groups.group(1))
     # we'll only take threads that are followed by evidence that there is at least one attachment
-    groups = re.search("""Latest attachment .* <button type="button" """, line)
+    groups = LATEST_ATTACHMENT_RE.search(line)
     if groups:
       candidates.append(candidate)
   # take the one with the most recent email
@@ -85,38 +109,32 @@ def get_thread_url_for_submission(commitfest_id, submission_id):
     result = "https://www.postgresql.org/message-id/flat/" + candidates[-1][1]
   return result
   
-AUTHOR_RE = re.compile("(.*) +\\(([^)]*)\\)")
+# one "Display Name (username)" entry in a comma-separated list
+AUTHOR_RE = re.compile("(?:^|, )((?:(?!, ).)*) +\\(((?:(?!, )[^)])*)\\)")
 
 # Parse list of names returning a dict of username => Display Name
 def parse_authors(line):
-  groups = re.search("<td>([^<]*)</td>", line)
+  groups = TD_RE.search(line)
   if not groups:
     return {}
-
-  ret = {}
-  authors = groups.group(1).split(', ')
-  for au in authors:
-    x = AUTHOR_RE.search(au)
-    if not x:
-      continue
-    ret[x.group(2)] = x.group(1)
-  return ret
+  return {username: name for name, username in AUTHOR_RE.findall(groups.group(1))}
 
 def get_submissions_for_commitfest(commitfest_id):
   """Given a Commitfest ID, return a list of Submission objects."""
   result = []
-  parser = HTMLParser()
   url = "https://commitfest.postgresql.org/%s/" % (commitfest_id,)
   next_line = None
   dic = dict(commitfest_id=int(commitfest_id), latest_email=None, authors=None)
-  for line in cfbot_util.slow_fetch(url).splitlines():
-    groups = re.search('\<a href="([0-9]+)/"\>([^<]+)</a>', line)
-    if groups:
-      dic['submission_id'] = int(groups.group(1))
-      dic['name'] = parser.unescape(groups.group(2))
+  for line in cfbot_util.slow_fetch_lines(url):
+    m = SUBMISSION_LINE_RE.search(line)
+    which = m.lastgroup if m else None
+    if which == 'submission':
+      submission_id, name = m.group(2, 3)
+      dic['submission_id'] = int(submission_id)
+      dic['name'] = unescape(name)
     if next_line == 'version':
       next_line = 'authors'
-      groups = re.search("<td><span [^>]*>([^<]*)</span></td>", line)
+      groups = VERSION_RE.search(line)
       version = None
       if groups:
         dic['version'] = groups.group(1)
@@ -134,27 +152,25 @@ def get_submissions_for_commitfest(commitfest_id):
 
     if next_line == 'committer':
       next_line = None # XXX numCFs
-      groups = re.search("<td>([^<]*)</td>", line)
+      groups = TD_RE.search(line)
       if groups:
         dic['committer'] = groups.group(1)
         continue
 
     if next_line == 'latest_email':
       next_line = None
-      groups = re.search('<td style="white-space: nowrap;">(.*)<br/>(.*)</td>', line)
-      if groups:
-        latest_email = groups.group(1) + " " + groups.group(2)
+      if which == 'email':
+        email_date, email_time = m.group(7, 8)
+        latest_email = email_date + " " + email_time
         if not latest_email.strip():
           latest_email = None
         dic['last_email_time'] = latest_email
         result.append(Submission(**dic))
-    groups = re.search('<td><span class="label label-[^"]*">([^<]+)</span></td>', line)
-    if groups:
-      dic['status'] = groups.group(1)
+    if which == 'status':
+      dic['status'] = m.group(5)
       next_line = 'version'
       continue
-    groups = re.search('<td style="white-space: nowrap;">.*<br/>.*</td>', line)
-    if groups:
+    if which == 'email':
       next_line = 'latest_email'
       continue
     next_line = None
@@ -162,11 +178,11 @@ def get_submissions_for_commitfest(commitfest_id):
   result.sort(key = lambda x: x.name)
   return result
 
-def get_current_commitfest_id():
-  """Find the ID of the current open or next future Commitfest."""
+def _fetch_current_commitfest_id():
+  """Scrape the ID of the current open or next future Commitfest."""
   result = None
-  for line in cfbot_util.slow_fetch("https://commitfest.postgresql.org").splitlines():
-    groups = re.search('<a href="/([0-9]+)/">[0-9]+-[0-9]+</a> \((Open|In Progress) ', line)
+  for line in cfbot_util.slow_fetch_lines("https://commitfest.postgresql.org"):
+    groups = COMMITFEST_RE.search(line)
     if groups:
       commitfest_id = groups.group(1)
       state = groups.group(2)
@@ -175,6 +191,22 @@ def get_current_commitfest_id():
     raise Exception("Could not determine the current Commitfest ID")
   return result
 
+def get_current_commitfest_id():
+  """Find the ID of the current open or next future Commitfest.  This only
+     changes every couple of months, so remember it in a file for up to an
+     hour."""
+  path = cfbot_config.COMMITFEST_ID_CACHE_FILE
+  try:
+    if time.time() - os.path.getmtime(path) < 3600:
+      with open(path) as f:
+        return int(f.read())
+  except (OSError, ValueError):
+    pass
+  result = _fetch_current_commitfest_id()
+  with open(path, "w") as f:
+    f.write(str(result))
+  return result
+
 class foocursor(object):
   def execute(self, *args):
      pass
@@ -11,6 +11,7 @@ USER_AGENT = "PostgreSQL patch tester at http://cfbot.cputube.org"
 TIMEOUT = 10
 
 LOCK_FILE="/tmp/cfbot-lock"
+COMMITFEST_ID_CACHE_FILE="/tmp/cfbot-commitfest-id"
 
 # database settings
 DSN="dbname=cfbot host=/tmp"
@@ -19,6 +20,7 @@ DSN="dbname=cfbot host=/tmp"
 PATCHBURNER_CTL="sudo ./cfbot_patchburner_chroot_ctl.sh"
 CYCLE_TIME = 48.0
 CONCURRENT_BUILDS = 1
+PATCHBASE_FETCH_INTERVAL = 300 # seconds between fetches of master
 
 # travis settings
 TRAVIS_USER="macdice"
@@ -16,29 +16,26 @@ import cfbot_commitfest_rpc
 import cfbot_config
 import cfbot_util
 import datetime as dt
-import glob
 import logging
 import os
+import requests
+import shlex
 import shutil
 import subprocess
-import tempfile
 import time
+from pathlib import Path
 from urllib.parse import urlparse
 
-def need_to_limit_rate(conn):
-  """Have we pushed too many branches recently?"""
-  # Don't let any provider finish up with more than the configured maximum
-  # number of builds still running.
-  cursor = conn.cursor()
-  cursor.execute("""SELECT COUNT(*)
-                      FROM branch
-                     WHERE status = 'testing'""")
-  row = cursor.fetchone()
-  return row and row[0] >= cfbot_config.CONCURRENT_BUILDS
+# Every query that picks a submission also claims it, by locking its row and
+# stamping last_branch_time in the same statement, skipping rows that another
+# run has already locked.  The row stays locked until the caller's transaction
+# commits.  Nothing is picked if too many branches are still being tested:
+# don't let any provider finish up with more than the configured maximum
+# number of builds still running.
 
 def choose_submission_with_new_patch(conn):
-  """Return the ID pair for the submission most deserving, because it has been
-     waiting the longest amongst submissions that have a new patch
+  """Claim and return the ID pair for the submission most deserving, because
+     it has been waiting the longest amongst submissions that have a new patch
      available."""
   # we'll use the last email time as an approximation of the time the patch
   # was sent, because it was most likely that message and it seems like a
@@ -46,13 +43,22 @@ def choose_submission_with_new_patch(conn):
   # attachment
   # -- wait a couple of minutes before probing because the archives are slow!
   cursor = conn.cursor()
-  cursor.execute("""SELECT commitfest_id, submission_id
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND last_message_id IS DISTINCT FROM last_branch_message_id
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                  ORDER BY last_email_time
-                     LIMIT 1""")
+  cursor.execute("""WITH picked AS (SELECT commitfest_id, submission_id
+                                      FROM submission
+                                     WHERE last_message_id IS NOT NULL
+                                       AND last_message_id IS DISTINCT FROM last_branch_message_id
+                                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
+                                       AND (SELECT COUNT(*) FROM branch WHERE status = 'testing') < %s
+                                  ORDER BY last_email_time
+                                     LIMIT 1
+                                       FOR UPDATE SKIP LOCKED)
+                    UPDATE submission s
+                       SET last_branch_time = now()
+                      FROM picked p
+                     WHERE s.commitfest_id = p.commitfest_id
+                       AND s.submission_id = p.submission_id
+                 RETURNING s.commitfest_id, s.submission_id""",
+                 (cfbot_config.CONCURRENT_BUILDS,))
   row = cursor.fetchone()
   if row:
     return row
@@ -60,39 +66,38 @@ def choose_submission_with_new_patch(conn):
     return None, None
 
 def choose_submission_without_new_patch(conn):
-  """Return the ID pair for the submission that has been waiting longest for
-     a periodic bitrot check, but only if we're under the configured rate per
-     hour (which is expressed as the cycle time to get through all
-     submissions)."""
-  # how many submissions are there?
+  """Claim and return the ID pair for the submission that has been waiting
+     longest for a periodic bitrot check, but only if we're under the
+     configured rate per hour (which is expressed as the cycle time to get
+     through all submissions)."""
+  # how many submissions are there, how many will we need to do per hour to
+  # approximate our target rate, and are we currently below that rate?  If so,
+  # pick the one that has waited longest.
   cursor = conn.cursor()
-  cursor.execute("""SELECT COUNT(*)
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')""")
-  number, = cursor.fetchone()
-  # how many will we need to do per hour to approximate our target rate?
-  target_per_hour = number / cfbot_config.CYCLE_TIME
-  # are we currently above or below our target rate?
-  cursor.execute("""SELECT COUNT(*)
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                       AND last_branch_time > now() - INTERVAL '1 hour'""")
-  current_rate_per_hour, = cursor.fetchone()
-  # is it time yet?
-  if current_rate_per_hour < target_per_hour:
-    cursor.execute("""SELECT commitfest_id, submission_id
-                        FROM submission
-                       WHERE last_message_id IS NOT NULL
-                         AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                    ORDER BY last_branch_time NULLS FIRST
-                       LIMIT 1""")
-    row = cursor.fetchone()
-    if row:
-      return row
-    else:
-      return None, None
+  cursor.execute("""WITH counts AS (SELECT COUNT(*) AS total,
+                                           COUNT(*) FILTER (WHERE last_branch_time > now() - INTERVAL '1 hour') AS recent
+                                      FROM submission
+                                     WHERE last_message_id IS NOT NULL
+                                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')),
+                         picked AS (SELECT s.commitfest_id, s.submission_id
+                                      FROM submission s, counts c
+                                     WHERE s.last_message_id IS NOT NULL
+                                       AND s.status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
+                                       AND c.recent < c.total / %s::float8
+                                       AND (SELECT COUNT(*) FROM branch WHERE status = 'testing') < %s
+                                  ORDER BY s.last_branch_time NULLS FIRST
+                                     LIMIT 1
+                                       FOR UPDATE OF s SKIP LOCKED)
+                    UPDATE submission s
+                       SET last_branch_time = now()
+                      FROM picked p
+                     WHERE s.commitfest_id = p.commitfest_id
+                       AND s.submission_id = p.submission_id
+                 RETURNING s.commitfest_id, s.submission_id""",
+                 (cfbot_config.CYCLE_TIME, cfbot_config.CONCURRENT_BUILDS))
+  row = cursor.fetchone()
+  if row:
+    return row
   else:
     return None, None
 
@@ -105,13 +110,39 @@ def choose_submission(conn):
   commitfest_id, submission_id = choose_submission_without_new_patch(conn)
   return commitfest_id, submission_id
 
+def reset_worktree(repo_dir):
+  """Throw away any leftovers from the last submission and go back to
+     master."""
+  subprocess.call(['git', 'am', '--abort', '-q'], cwd=repo_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  subprocess.check_call(['git', 'checkout', '-q', '--', '.'], cwd=repo_dir, stdout=subprocess.DEVNULL)
+  subprocess.check_call(['git', 'clean', '-fd'], cwd=repo_dir, stdout=subprocess.DEVNULL)
+  subprocess.check_call(['git', 'checkout', '-q', 'master'], cwd=repo_dir)
+
+def fetch_master(repo_dir):
+  """Fetch changes from PostgreSQL master, and move our master to match."""
+  subprocess.check_call(['git', 'fetch', '-q', 'origin', 'master'], cwd=repo_dir)
+  subprocess.check_call(['git', 'reset', '-q', '--hard', 'FETCH_HEAD'], cwd=repo_dir)
+
+def seconds_since_fetch(repo_dir):
+  """How long ago did we last fetch into this tree?  Each run is a separate
+     process, so use the modification time of FETCH_HEAD to find out."""
+  fetch_head = subprocess.check_output("git rev-parse --git-path FETCH_HEAD".split(), cwd=repo_dir).decode('utf-8').strip()
+  try:
+    return time.time() - os.path.getmtime(os.path.join(repo_dir, fetch_head))
+  except FileNotFoundError:
+    return None
+
 def update_patchbase_tree(repo_dir):
-  """Pull changes from PostgreSQL master. """
-  subprocess.check_call("git am --abort -q 2>/dev/null; git checkout . -q > /dev/null && git clean -fd > /dev/null && git checkout -q master && git pull -q", cwd=repo_dir, shell=True)
+  """Reset the tree to master, pulling in changes from PostgreSQL master if we
+     haven't done so recently."""
+  reset_worktree(repo_dir)
+  age = seconds_since_fetch(repo_dir)
+  if age is None or age > cfbot_config.PATCHBASE_FETCH_INTERVAL:
+    fetch_master(repo_dir)
 
 def get_commit_id(repo_dir):
   """ return the HEAD commit ID """
-  return subprocess.check_output("git rev-list HEAD -1".split(), cwd=repo_dir).decode('utf-8').strip()
+  return subprocess.check_output("git rev-parse HEAD".split(), cwd=repo_dir).decode('utf-8').strip()
 
 def make_branch(conn, patch_dir, **kwargs):
   # compose the commit message
@@ -132,19 +163,17 @@ Patch(es): https://www.postgresql.org/message-id/{message_id}
 Author(s): {authors}
 Base-Branch: {base_branch}
 """.format(**kwargs)
-  with tempfile.NamedTemporaryFile() as tmp:
-    tmp.write(commit_message.encode('utf-8'))
-    tmp.flush()
-    subprocess.check_call("git commit --allow-empty -q -F".split() + [tmp.name], cwd=patch_dir)
+  subprocess.run("git commit --allow-empty -q -F -".split(), input=commit_message.encode('utf-8'), cwd=patch_dir, check=True)
 
 def patchburner_ctl(command, want_rcode=False):
   """Invoke the patchburner control script."""
+  cmd = shlex.split(cfbot_config.PATCHBURNER_CTL) + shlex.split(command)
   if want_rcode:
-    p = subprocess.Popen("""%s %s""" % (cfbot_config.PATCHBURNER_CTL, command), shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     stdout, stderr = p.communicate()
     return stdout.decode('utf-8'), p.returncode
   else:
-    return subprocess.check_output("%s %s" % (cfbot_config.PATCHBURNER_CTL, command), shell=True).decode('utf-8')
+    return subprocess.check_output(cmd).decode('utf-8')
 
 def update_submission(conn, message_id, commit_id, commitfest_id, submission_id):
   # Unfortunately we also have to clobber last_message_id to avoid getting
@@ -166,7 +195,15 @@ def process_submission(conn, **kwargs):
   commitfest_id = kwargs['commitfest_id']
   submission_id = kwargs['submission_id']
   cursor = conn.cursor()
-  thread_url = cfbot_commitfest_rpc.get_thread_url_for_submission(commitfest_id, submission_id)
+  # use the thread URL that pull_modified_threads found, if we have it
+  cursor.execute("""SELECT thread_url
+                      FROM submission
+                     WHERE commitfest_id = %s AND submission_id = %s""",
+                 (commitfest_id, submission_id))
+  row = cursor.fetchone()
+  thread_url = row[0] if row else None
+  if not thread_url:
+    thread_url = cfbot_commitfest_rpc.get_thread_url_for_submission(commitfest_id, submission_id)
   if not thread_url:
     # CF entry with no thread attached?
     logging.info("skipping submission %s with no thread" % submission_id)
@@ -195,27 +232,29 @@ def process_submission(conn, **kwargs):
   #log_file = "patch_%d_%d.log" % (commitfest_id, submission_id)
   log_file = os.path.join(patch_dir, 'patch.out')
 
-  patches = []
-  for patch_url in patch_urls:
-    parsed = urlparse(patch_url)
-    filename = os.path.basename(parsed.path)
-    patches += [filename]
-    dest = os.path.join(patch_dir, filename)
-    with open(dest, "wb+") as f:
-      f.write(cfbot_util.slow_fetch_binary(patch_url))
+  patches = [os.path.basename(urlparse(patch_url).path) for patch_url in patch_urls]
+  try:
+    cfbot_util.slow_fetch_to_files(patch_urls, [os.path.join(patch_dir, filename) for filename in patches])
+  except requests.RequestException as e:
+    # a dead attachment link is reported like a patch that doesn't apply
+    with open(log_file, "a+") as log:
+      log.write("=== Could not fetch patches: %s ===\n" % e)
+    print(e)
+    rcode = 1
+    patches = []
 
   # decompress them XXX is it safe to run these on untrusted input ?
   for patch in patches:
-    if patch.endswith('.tgz') or patch.endswith('.tar.gz') or patch.endswith('.tar.bz2'):
+    if patch.endswith(cfbot_commitfest_rpc.TARBALL_SUFFIXES):
       subprocess.check_call(['tar', 'xzf', patch])
     elif patch.endswith('.zip'):
       subprocess.check_call(['unzip', patch])
     elif patch.endswith('.gz'):
       subprocess.check_call(['gunzip', patch])
 
-  patches = glob.glob(os.path.join(patch_dir, '*.diff'))
-  patches += glob.glob(os.path.join(patch_dir, '*.patch'))
-  patches.sort()
+  if rcode == 0:
+    patches = sorted(entry.name for entry in os.scandir(patch_dir)
+                     if entry.name.endswith(('.diff', '.patch')) and entry.is_file())
 
   # make a branch to apply the commits to
   branch = "commitfest/%s/%s" % (commitfest_id, submission_id)
@@ -227,9 +266,11 @@ def process_submission(conn, **kwargs):
         (commit_id, dt.datetime.now(dt.timezone.utc).isoformat()))
 
     for filename in patches:
+      # read each patch just once, and feed it to both mailinfo and am
+      data = Path(patch_dir, filename).read_bytes()
       cmd = 'git mailinfo ./msg ./patch'.split()
       p = subprocess.Popen(cmd, cwd=patch_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-      stdout , stderr = p.communicate(open(filename, 'rb').read())
+      stdout , stderr = p.communicate(data)
       msgsize = os.path.getsize(os.path.join(patch_dir, './msg'))
 
       if not stdout.strip() and msgsize == 0:
@@ -255,8 +296,8 @@ def process_submission(conn, **kwargs):
         #rcode = rcode or p.returncode
       else:
         cmd = 'git am --patch-format=mbox'.split()
-        p = subprocess.Popen(cmd + [os.path.basename(filename)], cwd=patch_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout , stderr = p.communicate()
+        p = subprocess.Popen(cmd, cwd=patch_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout , stderr = p.communicate(data)
         log.write(stdout.decode())
         print(stdout.decode())
         rcode = p.returncode
@@ -280,10 +321,9 @@ def process_submission(conn, **kwargs):
     return True
 
 def maybe_process_one(conn):
-  if not need_to_limit_rate(conn):
-    commitfest_id, submission_id = choose_submission(conn)
-    if submission_id:
-      process_submission(conn, commitfest_id=commitfest_id, submission_id=submission_id)
+  commitfest_id, submission_id = choose_submission(conn)
+  if submission_id:
+    process_submission(conn, commitfest_id=commitfest_id, submission_id=submission_id)
  
 
 if __name__ == "__main__":
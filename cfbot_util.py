@@ -1,21 +1,58 @@
 import cfbot_config
+import concurrent.futures
 import psycopg2
 import requests
+import shutil
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# share one session so that connections to the same host are kept alive and
+# reused, instead of paying for a new TCP+TLS handshake on every fetch
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                      max_retries=Retry(total=3, backoff_factor=0.3)))
+SESSION.headers['User-Agent'] = cfbot_config.USER_AGENT
 
 def slow_fetch(url):
   """Fetch the body of a web URL, but sleep every time too to be kind to the
      commitfest server."""
-  response = requests.get(url, headers={'User-Agent': cfbot_config.USER_AGENT}, timeout=cfbot_config.TIMEOUT)
+  response = SESSION.get(url, timeout=cfbot_config.TIMEOUT)
   time.sleep(cfbot_config.SLOW_FETCH_SLEEP)
   return response.text
 
-def slow_fetch_binary(url):
-  """Fetch the body of a web URL, but sleep every time too to be kind to the
-     commitfest server."""
-  response = requests.get(url, headers={'User-Agent': cfbot_config.USER_AGENT}, timeout=cfbot_config.TIMEOUT)
+def slow_fetch_lines(url):
+  """Like slow_fetch, but yield the body one line at a time as it arrives
+     instead of holding the whole page in memory."""
+  with SESSION.get(url, stream=True, timeout=cfbot_config.TIMEOUT) as response:
+    if response.encoding is None:
+      response.encoding = 'utf-8'
+    # split lines ourselves rather than with iter_lines(), which reads small
+    # chunks and can report a "\r\n" split across two chunks as two line
+    # breaks; the last piece of each chunk is held back as it may be partial
+    pending = ''
+    for chunk in response.iter_content(chunk_size=1 << 16, decode_unicode=True):
+      lines = (pending + chunk).splitlines(keepends=True)
+      pending = lines.pop() if lines else ''
+      for line in lines:
+        yield line.splitlines()[0]
+    yield from pending.splitlines()
   time.sleep(cfbot_config.SLOW_FETCH_SLEEP)
-  return response.content
+
+def slow_fetch_to_file(url, path):
+  """Fetch the body of a web URL, streaming it straight into a file instead
+     of holding it all in memory."""
+  with SESSION.get(url, stream=True, timeout=cfbot_config.TIMEOUT) as response:
+    response.raise_for_status()
+    response.raw.decode_content = True
+    with open(path, "wb") as f:
+      shutil.copyfileobj(response.raw, f, 1 << 20)
+  time.sleep(cfbot_config.SLOW_FETCH_SLEEP)
+
+def slow_fetch_to_files(urls, paths):
+  """Fetch several web URLs concurrently, each into the corresponding file."""
+  with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+    list(executor.map(slow_fetch_to_file, urls, paths))
 
 def gc(conn):
   cursor = conn.cursor()
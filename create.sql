@@ -6,6 +6,7 @@ create table submission (
   authors text[] not null,
   last_email_time timestamptz,
   last_email_time_checked timestamptz,
+  thread_url text, -- upgrade: ALTER TABLE submission ADD COLUMN IF NOT EXISTS thread_url text;
   last_message_id text,
   last_branch_message_id text,
   last_branch_commit_id text,